@@ -5,20 +5,69 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from enum import unique, IntEnum
+import os
 import json
+import math
+import time
 import jsone
+import hashlib
 import platform
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote_plus
 
-from components.utilities import Struct, merge_dictionaries, PUSH_HEALTH_IGNORED_DICTS, PUSH_HEALTH_IGNORED_KEYS
+from components.utilities import merge_dictionaries, PUSH_HEALTH_IGNORED_DICTS, PUSH_HEALTH_IGNORED_KEYS
 from components.logging import logEntryExit, logEntryExitNoArgs, LogLevel
 from components.providerbase import BaseProvider, INeedsCommandProvider, INeedsLoggingProvider
 
 # We want to run tests a total of four times
 TRIGGER_TOTAL = 4
 
+# The maximum number of job list pages we will request from Treeherder at once
+JOBS_PAGE_CONCURRENCY = 8
+
+# Failure classifications rarely change, so we only refresh our on-disk copy once a day
+FAILURE_CLASSIFICATIONS_CACHE_TTL = 60 * 60 * 24
+
+
+def _read_cache(path, ttl_s):
+    """
+    Returns a tuple of (data, fresh) from a cache file written by _write_cache.
+    If the file is missing or unreadable, data is None.
+    """
+    try:
+        with open(path, "r") as f:
+            cached = json.load(f)
+        return cached['data'], time.time() - cached['timestamp'] < ttl_s
+    except Exception:
+        return None, False
+
+
+def _write_cache(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to the side and rename so a concurrent reader never sees a partial file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({'timestamp': time.time(), 'data': obj}, f)
+    os.replace(tmp_path, path)
+
+
+def _strip_newlines(obj):
+    """
+    Returns a copy of a JSON-able object with every newline in its string values
+    replaced by a space.
+    """
+    if isinstance(obj, str):
+        return obj.replace("\n", " ")
+    if isinstance(obj, dict):
+        return {k: _strip_newlines(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_strip_newlines(v) for v in obj]
+    return obj
+
 
 # These are intentionally ordered so that the ones that override the others have a higher value
 @unique
@@ -131,6 +180,10 @@ class TaskclusterProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProv
         if 'url_taskcluster' in config:
             self.url_taskcluster = config['url_taskcluster']
 
+        self.cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "updatebot")
+        if 'cache_dir' in config:
+            self.cache_dir = config['cache_dir']
+
         # The project path is always try. Updatebot runs in mozilla-central (where there
         #   would be no project path), but it submits try runs to try; and this API is
         #   only about reading from try.
@@ -140,6 +193,15 @@ class TaskclusterProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProv
             'User-Agent': 'Updatebot'
         }
 
+        # All our requests go through one session so connections (and TLS sessions) are
+        # kept alive and reused. Transient server errors on GETs are retried.
+        self._session = requests.Session()
+        self._session.headers.update(self.HEADERS)
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                              max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504], raise_on_status=False))
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
     # =================================================================
     # =================================================================
     @logEntryExit
@@ -197,15 +259,19 @@ class TaskclusterProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProv
 
     @staticmethod
     def _transform_job_list(property_names, job_list):
+        # There can be thousands of jobs, so rather than a dictionary per job we use a class
+        # with a slot per property. (It can't be a namedtuple, as the decision task's
+        # decision_task refers to itself and so must be assigned after construction.)
+        job_class = type("Job", (), {'__slots__': tuple(property_names) + ('decision_task',)})
+
         decision_task = None
         new_job_list = []
         # We will need to reference the decision task, so we find populate that here also.
         for j in job_list:
-            d = {}
-            for i in range(len(property_names)):
-                d[property_names[i]] = j[i]
-
-            job_obj = Struct(**d, decision_task=None)
+            job_obj = job_class()
+            for name, value in zip(property_names, j):
+                setattr(job_obj, name, value)
+            job_obj.decision_task = None
             new_job_list.append(job_obj)
 
             if "Gecko Decision Task" == job_obj.job_type_name:
@@ -218,14 +284,39 @@ class TaskclusterProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProv
 
     # =================================================================
 
+    def _get_failure_classifications_cache_path(self):
+        # Key the cache by the Treeherder instance so different instances don't collide
+        url_hash = hashlib.sha1(self.url_treeherder.encode()).hexdigest()
+        return os.path.join(self.cache_dir, "failureclassifications-%s.json" % url_hash)
+
     def _get_failure_classifications(self):
         if not self._failure_classifications:
-            self.logger.log("Requesting failure classifications", level=LogLevel.Info)
-            r = requests.get(self.url_treeherder + "api/failureclassification/", headers=self.HEADERS)
-            try:
-                j = r.json()
-            except Exception:
-                raise Exception("Could not parse the result of the failureclassification request as json. Response:\n%s" % (r.text))
+            cache_path = self._get_failure_classifications_cache_path()
+            j, fresh = _read_cache(cache_path, FAILURE_CLASSIFICATIONS_CACHE_TTL)
+            if fresh:
+                self.logger.log("Using cached failure classifications from %s" % cache_path, level=LogLevel.Info)
+            else:
+                try:
+                    self.logger.log("Requesting failure classifications", level=LogLevel.Info)
+                    r = self._session.get(self.url_treeherder + "api/failureclassification/")
+                    if r.status_code != 200:
+                        raise Exception("The failureclassification request returned status code %s. Response:\n%s" % (r.status_code, r.text))
+                    try:
+                        response = r.json()
+                    except Exception:
+                        raise Exception("Could not parse the result of the failureclassification request as json. Response:\n%s" % (r.text))
+                    if not isinstance(response, list):
+                        raise Exception("The failureclassification request did not return a list. Response:\n%s" % (r.text))
+                    j = response
+                except Exception as e:
+                    if j is None:
+                        raise
+                    self.logger.log("Could not refresh the failure classifications, using the stale copy from %s. Error: %s" % (cache_path, e), level=LogLevel.Warning)
+                else:
+                    try:
+                        _write_cache(cache_path, j)
+                    except Exception as e:
+                        self.logger.log("Could not write the failure classifications to %s: %s" % (cache_path, e), level=LogLevel.Warning)
 
             failureclassifications = {}
             for f in j:
@@ -321,15 +412,18 @@ class TaskclusterProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProv
     def _get_push_list_url(self, revision):
         return self.url_treeherder + "api/%spush/?revision=%s" % (self.url_project_path, revision)
 
-    def _get_job_details_url(self, push_id):
-        return self.url_treeherder + "api/jobs/?push_id=%s" % push_id
+    def _get_job_details_url(self, push_id, page=None):
+        url = self.url_treeherder + "api/jobs/?push_id=%s" % push_id
+        if page:
+            url += "&page=%s" % page
+        return url
 
     @logEntryExit
     def get_job_details(self, revision):
         push_list_url = self._get_push_list_url(revision)
         self.logger.log("Requesting revision %s from %s" % (revision, push_list_url), level=LogLevel.Info)
 
-        r = requests.get(push_list_url, headers=self.HEADERS)
+        r = self._session.get(push_list_url)
         try:
             push_list = r.json()
         except Exception:
@@ -342,27 +436,46 @@ class TaskclusterProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProv
 
         job_list = []
         property_names = []
-        job_details_url = self._get_job_details_url(push_id)
-        try:
-            while job_details_url:
-                self.logger.log("Requesting push id %s from %s" % (push_id, job_details_url), level=LogLevel.Info)
-                r = requests.get(job_details_url, headers=self.HEADERS)
-                try:
-                    j = r.json()
-                except Exception:
-                    raise Exception("Could not parse the result of the jobs list as json. Url: %s Response:\n%s" % (job_details_url, r.text))
 
-                job_list.extend(j['results'])
-                if not property_names:
-                    property_names = j['job_property_names']
-                else:
-                    for i in range(len(property_names)):
-                        if len(property_names) != len(j['job_property_names']):
-                            raise Exception("The first j['job_property_names'] was %i elements long, but a subsequant one was %i for url %s" % (len(property_names), len(j['job_property_names']), job_details_url))
-                        elif property_names[i] != j['job_property_names'][i]:
-                            raise Exception("Property name %s (index %i) doesn't match %s" % (property_names[i], i, j['job_property_names'][i]))
+        def get_page(job_details_url):
+            self.logger.log("Requesting push id %s from %s" % (push_id, job_details_url), level=LogLevel.Info)
+            r = self._session.get(job_details_url)
+            try:
+                return r.json()
+            except Exception:
+                raise Exception("Could not parse the result of the jobs list as json. Url: %s Response:\n%s" % (job_details_url, r.text))
+
+        def add_page(j, job_details_url):
+            nonlocal property_names
+            job_list.extend(j['results'])
+            if not property_names:
+                property_names = j['job_property_names']
+            elif len(property_names) != len(j['job_property_names']):
+                raise Exception("The first j['job_property_names'] was %i elements long, but a subsequant one was %i for url %s" % (len(property_names), len(j['job_property_names']), job_details_url))
+            elif property_names != j['job_property_names']:
+                raise Exception("The first j['job_property_names'] %s doesn't match %s for url %s" % (property_names, j['job_property_names'], job_details_url))
 
-                job_details_url = j['next'] if 'next' in j else None
+            return j['next'] if 'next' in j else None
+
+        try:
+            job_details_url = self._get_job_details_url(push_id)
+            j = get_page(job_details_url)
+            next_url = add_page(j, job_details_url)
+
+            # The first page tells us how many jobs there are in total, so we can
+            # request all the remaining pages at once instead of walking 'next'.
+            if next_url and j.get('count') and j['results']:
+                last_page = math.ceil(j['count'] / len(j['results']))
+                remaining_urls = [self._get_job_details_url(push_id, page) for page in range(2, last_page + 1)]
+                if remaining_urls:
+                    with ThreadPoolExecutor(max_workers=min(JOBS_PAGE_CONCURRENCY, len(remaining_urls))) as executor:
+                        for job_details_url, j in zip(remaining_urls, executor.map(get_page, remaining_urls)):
+                            next_url = add_page(j, job_details_url)
+
+            # Without a count, or if jobs were added while we were paging, we have to follow 'next'.
+            while next_url:
+                job_details_url = next_url
+                next_url = add_page(get_page(job_details_url), job_details_url)
         except Exception as e:
             raise Exception("Could not obtain all the job results for push id %s" % push_id) from e
 
@@ -385,7 +498,7 @@ class TaskclusterProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProv
         push_health_url = self._get_push_health_url(revision)
         self.logger.log("Requesting push health for revision %s from %s" % (revision, push_health_url), level=LogLevel.Info)
 
-        r = requests.get(push_health_url, headers=self.HEADERS)
+        r = self._session.get(push_health_url)
         try:
             push_health = r.json()
         except Exception:
@@ -393,6 +506,13 @@ class TaskclusterProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProv
 
         return push_health
 
+    def get_job_details_and_health(self, revision):
+        # The job list and the push health are independent requests, so fetch them at the same time
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            job_details = executor.submit(self.get_job_details, revision)
+            push_health = executor.submit(self.get_push_health, revision)
+            return job_details.result(), push_health.result()
+
     @logEntryExitNoArgs
     def combine_push_healths(self, push_health_1, push_health_2):
         combined = merge_dictionaries(push_health_1, push_health_2,
@@ -418,7 +538,7 @@ class TaskclusterProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProv
 
             # Download its actions.json
             artifact_url = self.url_taskcluster + "api/queue/v1/task/%s/runs/0/artifacts/public/actions.json" % (decision_task.task_id)
-            r = requests.get(artifact_url, headers=self.HEADERS)
+            r = self._session.get(artifact_url)
             try:
                 actions = r.json()
             except Exception:
@@ -441,14 +561,16 @@ class TaskclusterProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProv
             }
             template = retrigger_action['hookPayload']
 
-            payload = jsone.render(template, context)
-            payload = json.dumps(payload).replace("\\n", " ")
+            # Flatten newlines in the rendered strings (including the template's own) rather than
+            # in the serialized text, where a literal backslash followed by 'n' would be mangled.
+            # Post it as UTF-8 bytes so requests sends it as-is.
+            payload = json.dumps(_strip_newlines(jsone.render(template, context))).encode()
 
             trigger_url = self.url_taskcluster + "api/hooks/v1/hooks/%s/%s/trigger" % \
                 (quote_plus(retrigger_action["hookGroupId"]), quote_plus(retrigger_action["hookId"]))
 
             self.logger.log("Issuing a retrigger to %s" % (trigger_url), level=LogLevel.Info)
-            r = requests.post(trigger_url, data=payload)
+            r = self._session.post(trigger_url, data=payload, headers={'Content-Type': 'application/json'})
             try:
                 if r.status_code == 200:
                     output = r.json()
@@ -20,6 +20,6 @@ class CommandProvider(BaseProvider, INeedsLoggingProvider):
         self.infolog = partial(self.logger.log, level=LogLevel.Info)
         self.debuglog = partial(self.logger.log, level=LogLevel.Debug)
 
-    def run(self, args, shell=False, clean_return=True):
+    def run(self, args, shell=False, clean_return=True, cwd=None, env=None):
         return _run(args, shell=shell, clean_return=clean_return,
-                    errorlog=self.errorlog, infolog=self.infolog, debuglog=self.debuglog)
+                    errorlog=self.errorlog, infolog=self.infolog, debuglog=self.debuglog, cwd=cwd, env=env)
@@ -23,7 +23,7 @@ and should be using a ComandProvider.
 """
 
 
-def _run(args, shell, clean_return, errorlog=do_nothing, infolog=do_nothing, debuglog=do_nothing):
+def _run(args, shell, clean_return, errorlog=do_nothing, infolog=do_nothing, debuglog=do_nothing, cwd=None, env=None):
     ran_to_completion = False
     stdout = None
     stderr = None
@@ -48,10 +48,13 @@ def _run(args, shell, clean_return, errorlog=do_nothing, infolog=do_nothing, deb
             args.insert(0, "python3")
 
     start = time.time()
-    infolog("Running", args)
+    if cwd:
+        infolog("Running", args, "in", cwd)
+    else:
+        infolog("Running", args)
     try:
         ret = subprocess.run(
-            args, shell=shell, stdout=PIPE, stderr=PIPE, timeout=60 * 20)
+            args, shell=shell, stdout=PIPE, stderr=PIPE, timeout=60 * 20, cwd=cwd, env=env)
     except subprocess.TimeoutExpired as e:
         ran_to_completion = False
         stdout = e.stdout
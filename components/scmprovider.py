@@ -3,8 +3,10 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import re
 import copy
 import shutil
+import hashlib
 import tempfile
 import functools
 
@@ -25,11 +27,14 @@ def repo_and_commit_to_url(repo, commit):
 
 
 class Commit:
+    # There may be thousands of these in a large update, so don't give each one a __dict__
+    __slots__ = ('revision', 'author_date', 'commit_date',
+                 'files_modified', 'files_added', 'files_deleted', 'files_other',
+                 'summary', 'author', 'description', 'revision_link_prefix', 'populated')
+
     def __init__(self, pretty_line):
-        parts = pretty_line.split("|")
-        self.revision = parts[0]
-        self.author_date = parts[1]
-        self.commit_date = parts[2]
+        self.revision, _, dates = pretty_line.partition("|")
+        self.author_date, _, self.commit_date = dates.partition("|")
 
         self.files_modified = []
         self.files_added = []
@@ -38,34 +43,39 @@ class Commit:
 
         self.populated = False
 
-    def populate_details(self, repo, run):
-        if self.populated:
-            return
-
-        rev_range = [self.revision + "^", self.revision]
-
-        files_changed = run(["git", "diff", "--name-status"] + rev_range).stdout.decode().split("\n")
-        for f in files_changed:
-            f = f.strip()
-            if not f:
-                continue
-
-            parts = f.split("\t")
-            if parts[0] == 'M':
-                self.files_modified.append(parts[1])
-            elif parts[0] == 'A':
-                self.files_added.append(parts[1])
-            elif parts[0] == 'D':
-                self.files_deleted.append(parts[1])
+    def set_details(self, revision_link_prefix, author, summary, description, name_status):
+        """
+        name_status is the list of NUL-separated tokens git emits for
+        `--name-status -z`: a status followed by one path, or two for
+        renames and copies.
+        """
+        i = 0
+        while i < len(name_status):
+            status = name_status[i]
+            path = name_status[i + 1]
+            i += 3 if status[0] in "RC" else 2
+
+            if status == 'M':
+                self.files_modified.append(path)
+            elif status == 'A':
+                self.files_added.append(path)
+            elif status == 'D':
+                self.files_deleted.append(path)
             else:
-                self.files_other.append(parts[0] + " " + parts[1])
-
-        self.summary = run(["git", "log", "--pretty=%s", "-1", self.revision]).stdout.decode()
-        self.author = run(["git", "log", "--pretty=%an", "-1", self.revision]).stdout.decode()
-        self.description = run(["git", "log", "--pretty=%b", "-1", self.revision]).stdout.decode()
-        self.revision_link = repo_and_commit_to_url(repo, self.revision)
+                self.files_other.append(status + " " + path)
+
+        # git terminates each of these with a newline when asked for them individually,
+        # and the bug description formatting expects that.
+        self.summary = summary + "\n"
+        self.author = author + "\n"
+        self.description = description + "\n"
+        self.revision_link_prefix = revision_link_prefix
         self.populated = True
 
+    @property
+    def revision_link(self):
+        return self.revision_link_prefix + self.revision
+
     def __eq__(self, other):
         if isinstance(other, Commit):
             return self.revision == other.revision
@@ -75,7 +85,7 @@ class Commit:
         return "Commit: " + self.revision
 
     def __hash__(self):
-        return int(self.revision, 16)
+        return hash(self.revision)
 
 
 def _contains_commit(list_of_commits, revision):
@@ -87,35 +97,105 @@ def _contains_commit(list_of_commits, revision):
 
 class SCMProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProvider):
     def __init__(self, config):
-        pass
+        # Mirrors of the upstream repositories are kept here between runs, so we only
+        # need to fetch new commits instead of cloning the whole repository every time.
+        self.mirror_dir = os.path.join(os.path.expanduser("~"), ".cache", "updatebot", "scm-mirrors")
+        if 'mirror_dir' in config:
+            self.mirror_dir = config['mirror_dir']
+
+        # Built once and shared by every git call. We only read from our checkouts, so git
+        # needn't take optional locks, and we parse its output so we don't want it localized.
+        self._git_env = dict(os.environ, GIT_OPTIONAL_LOCKS='0', LC_ALL='C')
 
     def _initialize(self):
         self.tmpdirname = tempfile.mkdtemp()
-        self.previous_dir_stack = list()  # We use this as a Stack with append/pop
+        self.mirror_path = None
         self._has_checkedout = False
 
     def _reset(self):
+        self._remove_worktree()
+
+    def _remove_worktree(self):
+        if self.mirror_path and os.path.isdir(self.mirror_path):
+            self._git(["worktree", "remove", "--force", self.tmpdirname], clean_return=False, cwd=self.mirror_path)
+        # Only needed if we never added a worktree, or removing it failed
         shutil.rmtree(self.tmpdirname, ignore_errors=True)
+        self._has_checkedout = False
 
-    def _ensure_checkout(self, repo_url, specific_revision=None):
-        self.previous_dir_stack.append(os.getcwd())
+    def _ensure_mirror(self, repo_url):
+        mirror_path = os.path.join(self.mirror_dir, hashlib.sha1(repo_url.encode()).hexdigest())
+
+        if os.path.isdir(mirror_path):
+            try:
+                self._update_mirror(mirror_path)
+                return mirror_path
+            except Exception:
+                # Don't let a mirror we can't update break this library on every run from now on
+                self.logger.log("Could not update the mirror of %s, cloning it again." % repo_url, level=LogLevel.Warning)
+                shutil.rmtree(mirror_path, ignore_errors=True)
 
-        os.chdir(self.tmpdirname)
+        os.makedirs(self.mirror_dir, exist_ok=True)
+        try:
+            # A full clone: git log --name-status needs blobs for rename detection, and
+            # fetching those on demand from a partial clone would cost a round-trip each.
+            # We don't use --mirror, as that would also fetch refs/pull/* and the like;
+            # we only want branches and tags. Both are force-updated, as upstream may move
+            # a tag (e.g. 'nightly') as well as rewrite a branch.
+            self._git(["clone", "--bare", repo_url, mirror_path])
+            self._git(["config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*"], cwd=mirror_path)
+            self._git(["config", "--add", "remote.origin.fetch", "+refs/tags/*:refs/tags/*"], cwd=mirror_path)
+        except Exception:
+            # Don't leave a half-cloned mirror behind for the next run to trip over
+            shutil.rmtree(mirror_path, ignore_errors=True)
+            raise
+
+        return mirror_path
+
+    def _update_mirror(self, mirror_path):
+        self._git(["fetch", "--prune", "origin"], cwd=mirror_path)
+        self._update_mirror_head(mirror_path)
+        # Drop the registrations of any worktrees whose directories have since been deleted,
+        # e.g. by a run that was killed before it could remove its worktree
+        self._git(["worktree", "prune"], cwd=mirror_path)
+
+    def _update_mirror_head(self, mirror_path):
+        """
+        Points the mirror's HEAD at upstream's default branch. Fetching doesn't do this, so if
+        upstream renamed its default branch, HEAD would be left pointing at a pruned branch.
+        """
+        ret = self._git(["ls-remote", "--symref", "origin", "HEAD"], clean_return=False, cwd=mirror_path)
+        if ret.returncode:
+            return
+        for line in ret.stdout.decode().splitlines():
+            target, _, name = line.partition("\t")
+            if name == "HEAD" and target.startswith("ref: "):
+                self._git(["symbolic-ref", "HEAD", target[len("ref: "):]], cwd=mirror_path)
+                return
 
+    def _ensure_checkout(self, repo_url, specific_revision=None):
         if not self._has_checkedout:
             if not repo_url:
                 raise Exception("Wound up in _ensure_checkout but missing a repo_url")
 
-            self.run(["git", "clone", repo_url, "."])
-
-            if specific_revision:
-                self.run(["git", "checkout", specific_revision])
+            self.mirror_path = self._ensure_mirror(repo_url)
+            # We only ever ask git about history, which lives in the mirror's object store, so the
+            # worktree doesn't need any files checked out.
+            self._git(["worktree", "add", "--no-checkout", "--detach", self.tmpdirname, specific_revision or "HEAD"], cwd=self.mirror_path)
 
             self._has_checkedout = True
 
     @logEntryExit
     @Memoize
     def check_for_update(self, library, task, new_version, most_recent_job):
+        try:
+            return self._check_for_update(library, task, new_version, most_recent_job)
+        except Exception:
+            # The task is about to fail, and won't reset() us, so don't leave our worktree
+            # registered in the mirror
+            self._remove_worktree()
+            raise
+
+    def _check_for_update(self, library, task, new_version, most_recent_job):
         # This function uses two tricky variable names:
         #  all_upstream_commits - This means the commits that have occured upstream, on the branch we care about,
         #                         between the library's current revision and the tip of the branch.
@@ -130,97 +210,149 @@ class SCMProvider(BaseProvider, INeedsCommandProvider, INeedsLoggingProvider):
         #  We do return both lists, because while we only need the unseen list for filing a new bug, we need the
         #  all-upstream list to mark any open bugs as (potentially) affecting a new FF version.
 
-        # This try block is used to ensure we clean up and chdir at the end always. It has no except clause,
-        # exceptions raised are sent up the stack.
-        try:
-            # Step 0: Get the repo and update to the correct branch.
-            # If no branch is specified, the default branch we clone is assumed to be correct
-            self._ensure_checkout(library.repo_url, task.branch)
-
-            # Step 1: Find the common ancestor between the commit we are and new_version
-            common_ancestor = self.run(["git", "merge-base", library.revision, new_version]).stdout.decode().strip()
-            self.logger.log("Our common ancestor is %s." % (common_ancestor), level=LogLevel.Debug)
-
-            # Step 2: Get the list of commits between the common ancestor and new_version
-            all_new_upstream_commits = self._commits_between(common_ancestor, new_version)
-            if not all_new_upstream_commits:
-                self.logger.log("Checking for updates to %s but no new upstream commits were found from our current in-tree revision %s." % (library.name, library.revision), level=LogLevel.Info)
-                return [], []
-
-            # We do have new upstream commits.
-            # Step 4: Check if the most recent job was performed on a revision _after_ the library's current revision or _before_.
-            # 'After the library's current revision' means:
-            #        in m-c we update the library to A
-            #        then B was commited upstream
-            #        we saw B and then ran a job for it
-            #        Resulting in the most recent job being run after the library's current revision
-            # 'Before the library's current revision' means:
-            #        (the above happens)
-            #        in m-c we update the library to B (or maybe even a new rev C with no job)
-            #        Resulting in the most recent job (which was for B) occured _before_ the library's current revision
-            # We can only do this if we have a most recent job, if we don't we're processing this library for the first time
-            if most_recent_job:
-                most_recent_job_newer_than_library_rev = most_recent_job.version in [c.revision for c in all_new_upstream_commits]
-                if most_recent_job_newer_than_library_rev:
-                    self.logger.log("The most recent job we have run is for a revision still upstream and not in the mozilla repo.", level=LogLevel.Debug)
-                else:
-                    self.logger.log("The most recent job we have run is older than the current revision in the mozilla repo.", level=LogLevel.Debug)
-            else:
-                self.logger.log("We've never run a job for this library before.", level=LogLevel.Debug)
-                most_recent_job_newer_than_library_rev = False
-
-            unseen_new_upstream_commits = []
+        # If upstream is still at the revision we have, there's nothing new and we can skip
+        # updating the mirror and checking it out entirely.
+        if self._remote_revision(library.repo_url, new_version) == library.revision:
+            self.logger.log("Checking for updates to %s but upstream %s is still at our current in-tree revision %s." % (library.name, new_version, library.revision), level=LogLevel.Info)
+            return [], []
+
+        # Step 0: Get the repo and update to the correct branch.
+        # If no branch is specified, the default branch we clone is assumed to be correct
+        self._ensure_checkout(library.repo_url, task.branch)
+
+        # Step 1: Find the common ancestor between the commit we are and new_version
+        common_ancestor = self._git(["merge-base", library.revision, new_version], cwd=self.tmpdirname).stdout.decode().strip()
+        self.logger.log("Our common ancestor is %s." % (common_ancestor), level=LogLevel.Debug)
+
+        # Step 2: Get the list of commits between the common ancestor and new_version
+        all_new_upstream_commits = self._commits_between(common_ancestor, new_version)
+        if not all_new_upstream_commits:
+            self.logger.log("Checking for updates to %s but no new upstream commits were found from our current in-tree revision %s." % (library.name, library.revision), level=LogLevel.Info)
+            return [], []
+
+        # We do have new upstream commits.
+        # Step 4: Check if the most recent job was performed on a revision _after_ the library's current revision or _before_.
+        # 'After the library's current revision' means:
+        #        in m-c we update the library to A
+        #        then B was commited upstream
+        #        we saw B and then ran a job for it
+        #        Resulting in the most recent job being run after the library's current revision
+        # 'Before the library's current revision' means:
+        #        (the above happens)
+        #        in m-c we update the library to B (or maybe even a new rev C with no job)
+        #        Resulting in the most recent job (which was for B) occured _before_ the library's current revision
+        # We can only do this if we have a most recent job, if we don't we're processing this library for the first time
+        all_new_upstream_revisions = {c.revision for c in all_new_upstream_commits}
+        if most_recent_job:
+            most_recent_job_newer_than_library_rev = most_recent_job.version in all_new_upstream_revisions
             if most_recent_job_newer_than_library_rev:
-                # Step 5: Get the list of commits between the revision for the most recent job
-                # and new_version. (We previously confirmed that most_recent_job.version is in the sequence
-                # of commits from common_ancestor..new_version)
-                unseen_new_upstream_commits = self._commits_between(most_recent_job.version, new_version)
-                if len(unseen_new_upstream_commits) == 0:
-                    self.logger.log("Already processed revision %s in bug %s" % (most_recent_job.version, most_recent_job.bugzilla_id), level=LogLevel.Info)
-                    return all_new_upstream_commits, []
-
-                # Step 6: Ensure that the unseen list of a subset of the 'all-new' list
-                # Techinically this is optional; we could have started at Step 3. But this approach is
-                # more conservative and will help us identify unexpected situations that may invalidate
-                # our assumptions about how things should happen.
-                # Indeed, originally we verified that the unseen list was an ordered subset of the all-new list
-                # but this assertion triggered because it may not be.  We may have 1 -> 2 -> 3 with a most recent job
-                # of 3.  And then we have a commit added that, when sorted by date, goes 1 -> 2 -> 4 -> 3 -> 5
-                # where 5 is a merge commit.  This is perfectly legal and it screws up the assumption that
-                # we'll have an ordered subset.
-                assert len(all_new_upstream_commits) > len(unseen_new_upstream_commits), "Somehow the all-new list is not greater than the unseen list?"
-
-                error_func = functools.partial(self._print_differing_commit_lists, all_new_upstream_commits, "all_new_upstream_commits", unseen_new_upstream_commits, "unseen_new_upstream_commits")
-                if not set(unseen_new_upstream_commits).issubset(set(all_new_upstream_commits)):
-                    error_func("unseen_new_upstream_commits is not a subset of all_new_upstream_commits")
-
-            else:  # not most_recent_job_newer_than_library_rev
-                # If the most recent job isn't in the list of all new upstream commits; then the entire
-                # list of new upstream commits is the list of the unseen upstream commits.
-                unseen_new_upstream_commits = all_new_upstream_commits
-
-            # Step 7: Populate the lists with additional details about the commits
-            [c.populate_details(library.repo_url, self.run) for c in unseen_new_upstream_commits]
-            [c.populate_details(library.repo_url, self.run) for c in all_new_upstream_commits]
-
-        finally:
-            # Step 8 Return us to the origin directory
-            os.chdir(self.previous_dir_stack.pop())
-
-        # Step 9: Return it
+                self.logger.log("The most recent job we have run is for a revision still upstream and not in the mozilla repo.", level=LogLevel.Debug)
+            else:
+                self.logger.log("The most recent job we have run is older than the current revision in the mozilla repo.", level=LogLevel.Debug)
+        else:
+            self.logger.log("We've never run a job for this library before.", level=LogLevel.Debug)
+            most_recent_job_newer_than_library_rev = False
+
+        unseen_new_upstream_commits = []
+        if most_recent_job_newer_than_library_rev:
+            # Step 5: Get the list of commits between the revision for the most recent job
+            # and new_version. (We previously confirmed that most_recent_job.version is in the sequence
+            # of commits from common_ancestor..new_version)
+            unseen_new_upstream_commits = self._commits_between(most_recent_job.version, new_version)
+            if len(unseen_new_upstream_commits) == 0:
+                self.logger.log("Already processed revision %s in bug %s" % (most_recent_job.version, most_recent_job.bugzilla_id), level=LogLevel.Info)
+                return all_new_upstream_commits, []
+
+            # Step 6: Ensure that the unseen list of a subset of the 'all-new' list
+            # Techinically this is optional; we could have started at Step 3. But this approach is
+            # more conservative and will help us identify unexpected situations that may invalidate
+            # our assumptions about how things should happen.
+            # Indeed, originally we verified that the unseen list was an ordered subset of the all-new list
+            # but this assertion triggered because it may not be.  We may have 1 -> 2 -> 3 with a most recent job
+            # of 3.  And then we have a commit added that, when sorted by date, goes 1 -> 2 -> 4 -> 3 -> 5
+            # where 5 is a merge commit.  This is perfectly legal and it screws up the assumption that
+            # we'll have an ordered subset.
+            assert len(all_new_upstream_commits) > len(unseen_new_upstream_commits), "Somehow the all-new list is not greater than the unseen list?"
+
+            error_func = functools.partial(self._print_differing_commit_lists, all_new_upstream_commits, "all_new_upstream_commits", unseen_new_upstream_commits, "unseen_new_upstream_commits")
+            if not all_new_upstream_revisions.issuperset(c.revision for c in unseen_new_upstream_commits):
+                error_func("unseen_new_upstream_commits is not a subset of all_new_upstream_commits")
+
+        else:  # not most_recent_job_newer_than_library_rev
+            # If the most recent job isn't in the list of all new upstream commits; then the entire
+            # list of new upstream commits is the list of the unseen upstream commits.
+            unseen_new_upstream_commits = all_new_upstream_commits
+
+        # Step 7: Populate the lists with additional details about the commits
+        # The unseen list is a subset of the all-new list, so one pass over common_ancestor..new_version covers both
+        self._populate_details(library.repo_url, common_ancestor, new_version, all_new_upstream_commits + unseen_new_upstream_commits)
+
+        # Step 8: Return it
         return all_new_upstream_commits, unseen_new_upstream_commits
 
+    def _git(self, args, clean_return=True, cwd=None):
+        return self.run(["git"] + args, clean_return=clean_return, cwd=cwd, env=self._git_env)
+
+    def _remote_revision(self, repo_url, ref):
+        """
+        Returns the revision ref points to in the upstream repository, without fetching anything.
+        Returns None if we can't tell.
+        """
+        if re.fullmatch("[0-9a-f]{40}", ref):
+            return ref
+
+        # ls-remote matches patterns against the end of the refname, so 'main' would also match
+        # refs/heads/a/main; ask for the full refname and only accept an exact match.
+        refname = ref if ref == "HEAD" or ref.startswith("refs/") else "refs/heads/" + ref
+        ret = self._git(["ls-remote", repo_url, refname], clean_return=False)
+        if ret.returncode:
+            return None
+        for line in ret.stdout.decode().splitlines():
+            revision, _, name = line.partition("\t")
+            if name == refname:
+                return revision
+        return None
+
     def _commits_between(self, revision1, revision2):
         """
         Returns the commits rev1 and rev2, not including rev1.
         If rev1 == rev2, returns an empty list.
         """
-        ret = self.run(["git", "log", "--pretty=%H|%ai|%ci", "--no-merges", "%s..%s" % (revision1, revision2)])
-        commits = [line.strip() for line in ret.stdout.decode().split("\n")]
-        # Put them in order of oldest to newest
-        commits.reverse()
+        # --reverse puts them in order of oldest to newest
+        ret = self._git(["log", "--pretty=%H|%ai|%ci", "--reverse", "--no-merges", "%s..%s" % (revision1, revision2)], cwd=self.tmpdirname)
         # Populate them into a class but don't get details just yet.
-        return [Commit(c) for c in commits if c]
+        return [Commit(line) for line in ret.stdout.decode().splitlines() if line]
+
+    def _populate_details(self, repo_url, revision1, revision2, commits):
+        """
+        Populates the details of the given commits, which must all be in revision1..revision2,
+        using a single git log call rather than several git calls per commit.
+        """
+        if all(c.populated for c in commits):
+            return
+
+        # Each commit is output as \x01<header fields separated by \0>\x02 followed by its
+        # NUL-separated --name-status output
+        ret = self._git(["log", "--no-merges", "-z", "--name-status", "--pretty=format:%x01%H%x00%an%x00%s%x00%b%x02", "%s..%s" % (revision1, revision2)], cwd=self.tmpdirname)
+
+        # The link format only depends on the repository, so work it out once for all the commits
+        revision_link_prefix = repo_and_commit_to_url(repo_url, "")
+
+        details = {}
+        for record in ret.stdout.decode().split("\x01"):
+            if not record:
+                continue
+            header, _, name_status = record.partition("\x02")
+            revision, author, summary, description = header.split("\x00", 3)
+            details[revision] = (author, summary, description, [t for t in name_status.strip("\x00\n").split("\x00") if t])
+
+        for c in commits:
+            # The same commit object may be passed more than once
+            if c.populated:
+                continue
+            if c.revision not in details:
+                raise Exception("Could not find the details of commit %s in %s..%s" % (c.revision, revision1, revision2))
+            c.set_details(revision_link_prefix, *details[c.revision])
 
     def _print_differing_commit_lists(self, list_a, list_a_name, list_b, list_b_name, problem):
         self.logger.log("%s." % problem, level=LogLevel.Error)
@@ -301,10 +301,8 @@ class VendorTaskRunner(BaseTaskRunner):
         job_list = []
         push_health = {}
         for t in existing_job.try_runs:
-            this_job_list = self.taskclusterProvider.get_job_details(t.revision)
+            this_job_list, this_push_health = self.taskclusterProvider.get_job_details_and_health(t.revision)
             job_list = self.taskclusterProvider.combine_job_lists(job_list, this_job_list)
-
-            this_push_health = self.taskclusterProvider.get_push_health(t.revision)
             push_health = self.taskclusterProvider.combine_push_healths(push_health, this_push_health)
 
         if not self._job_is_completed_without_build_failures(library, existing_job, this_job_list):
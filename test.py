@@ -13,6 +13,7 @@ TESTS = [
     "bugzilla",
     "automation_configuration",
     "run_command",
+    "scm",
     "functionality_commitalert",
     "functionality_all_platforms",
     "functionality_two_platforms",
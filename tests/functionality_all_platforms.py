@@ -4,12 +4,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import sys
 import copy
+import shutil
 import inspect
 import unittest
 import itertools
 import functools
+import tempfile
 
 from http import server
 from threading import Thread
@@ -103,6 +106,9 @@ class TestFunctionality(SimpleLoggingTest):
         db_config = transform_db_config_to_tmp_db(localconfig['Database'])
         db_config['keep_tmp_db'] = keep_tmp_db
 
+        # Keep the on-disk caches out of the real ~/.cache/updatebot
+        self.cache_dir = tempfile.mkdtemp()
+
         configs = {
             'General': {
                 'env': 'dev',
@@ -124,6 +130,10 @@ class TestFunctionality(SimpleLoggingTest):
             'Taskcluster': {
                 'url_treeherder': 'http://localhost:27490/',
                 'url_taskcluster': 'http://localhost:27490/',
+                'cache_dir': self.cache_dir,
+            },
+            'SCM': {
+                'mirror_dir': os.path.join(self.cache_dir, "scm-mirrors"),
             },
             'Phabricator': {},
             'Library': {
@@ -151,6 +161,7 @@ class TestFunctionality(SimpleLoggingTest):
     def _cleanup(self, u, expected_values):
         self.server.shutdown()
         self.server.server_close()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
         for lib in u.libraryProvider.get_libraries(u.config_dictionary['General']['gecko-path']):
             for task in lib.tasks:
                 if task.type != 'vendoring':
@@ -6,9 +6,11 @@
 
 import sys
 import copy
+import shutil
 import inspect
 import unittest
 import functools
+import tempfile
 
 sys.path.append(".")
 sys.path.append("..")
@@ -170,6 +172,10 @@ class TestFunctionality(SimpleLoggingTest):
             },
             'Mercurial': {},
             'Taskcluster': {},
+            'SCM': {
+                # Keep the mirrors out of the real ~/.cache/updatebot
+                'mirror_dir': tempfile.mkdtemp(),
+            },
             'Phabricator': {},
             'Library': {
                 'commitalert_revision_override': current_library_version_func,
@@ -193,6 +199,7 @@ class TestFunctionality(SimpleLoggingTest):
 
     @staticmethod
     def _cleanup(u, library_filter):
+        shutil.rmtree(u.config_dictionary['SCM']['mirror_dir'], ignore_errors=True)
         for lib in u.libraryProvider.get_libraries(u.config_dictionary['General']['gecko-path']):
             if library_filter not in lib.name:
                 continue
@@ -83,13 +83,16 @@ def SHARED_COMMAND_MAPPINGS(expected_values, command_callbacks):
         (echo_str("echo {\"transactions\": [{\"type\":\"abandon\""), command_callbacks.get('abandon', AssertFalse)),
         (echo_str("echo {\"transactions\": [{\"type\":\"bugzilla.bug-id\""), lambda: CONDUIT_EDIT_OUTPUT),
         ("git log -1 --oneline", lambda: "0481f1c (HEAD -> issue-115-add-revision-to-log, origin/issue-115-add-revision-to-log) Issue #115 - Add revision of updatebot to log output"),
-        ("git clone https://example.invalid .", lambda: ""),
+        ("git ls-remote --symref origin HEAD", lambda: "ref: refs/heads/main\tHEAD\n"),
+        ("git ls-remote", lambda cmd: "%s\t%s\n" % (expected_values.library_new_version_id(), cmd.split()[-1])),
+        ("git clone --bare https://example.invalid", lambda: ""),
+        ("git config remote.origin.fetch", lambda: ""),
+        ("git fetch --prune --tags origin", lambda: ""),
+        ("git symbolic-ref HEAD", lambda: ""),
+        ("git worktree", lambda: ""),
         ("git merge-base", lambda: "_current"),
-        ("git log --pretty=%H|%ai|%ci", lambda cmd: "\n".join(expected_values.git_pretty_output_func("_current" not in cmd))),
-        ("git diff --name-status", lambda: GIT_DIFF_FILES_CHANGES),
-        ("git log --pretty=%s", lambda: "Roll SPIRV-Tools from a61d07a72763 to 1cda495274bb (1 revision)"),
-        ("git log --pretty=%an", lambda: "Tom Ritter"),
-        ("git log --pretty=%b", lambda: GIT_COMMIT_BODY),
+        ("git log --pretty=%H|%ai|%ci --reverse", lambda cmd: "\n".join(reversed(expected_values.git_pretty_output_func("_current" not in cmd)))),
+        ("git log --no-merges -z --name-status", lambda cmd: GIT_LOG_DETAILS(expected_values.git_pretty_output_func("_current" not in cmd))),
     ])
 
 
@@ -170,14 +173,14 @@ CONDUIT_EDIT_OUTPUT = """
 {"error":null,"errorMessage":null,"response":{"object":{"id":3643,"phid":"PHID-DREV-4pi6s6fwd57bktfzvfns"},"transactions":[{"phid":"PHID-XACT-DREV-om5mlg2ib34yaoi"},{"phid":"PHID-XACT-DREV-2pzq4qktezb7qqc"}]}}
 """
 
-GIT_DIFF_FILES_CHANGES = """
-M	src/libANGLE/renderer/vulkan/VertexArrayVk.cpp
-M	src/tests/gl_tests/StateChangeTest1.cpp
-A	src/tests/gl_tests/StateChangeTest2.cpp
-D	src/tests/gl_tests/StateChangeTest3.cpp
-R	src/tests/gl_tests/StateChangeTest4.cpp
-Q	src/tests/gl_tests/StateChangeTest5.cpp
-"""
+GIT_DIFF_FILES_CHANGES = [
+    "M", "src/libANGLE/renderer/vulkan/VertexArrayVk.cpp",
+    "M", "src/tests/gl_tests/StateChangeTest1.cpp",
+    "A", "src/tests/gl_tests/StateChangeTest2.cpp",
+    "D", "src/tests/gl_tests/StateChangeTest3.cpp",
+    "R100", "src/tests/gl_tests/StateChangeTest4.cpp", "src/tests/gl_tests/StateChangeTest4a.cpp",
+    "Q", "src/tests/gl_tests/StateChangeTest5.cpp",
+]
 
 GIT_COMMIT_BODY = """
 If glBufferSubData results in a new vk::BufferHelper allocation,
@@ -198,6 +201,15 @@ Commit-Queue: Jamie Madill <jmadill@chromium.org>
 """
 
 
+# Mimics the output of the single git log call SCMProvider uses to populate commit details
+def GIT_LOG_DETAILS(pretty_lines):
+    s = ""
+    for line in pretty_lines:
+        header = [line.split("|")[0], "Tom Ritter", "Roll SPIRV-Tools from a61d07a72763 to 1cda495274bb (1 revision)", GIT_COMMIT_BODY]
+        s += "\x01" + "\x00".join(header) + "\x02\x00\n" + "\x00".join(GIT_DIFF_FILES_CHANGES) + "\x00"
+    return s
+
+
 ALL_BUGS = False
 ONLY_OPEN = True
 
@@ -30,7 +30,7 @@ class TestCommandProvider(BaseProvider, INeedsLoggingProvider):
         if 'real_runner' in config:
             self.real_runner = config['real_runner']
 
-    def run(self, args, shell=False, clean_return=True):
+    def run(self, args, shell=False, clean_return=True, cwd=None, env=None):
         argument_string = args
         if isinstance(args, list):
             argument_string = " ".join(args)
@@ -43,7 +43,7 @@ class TestCommandProvider(BaseProvider, INeedsLoggingProvider):
                 if self.mappings[m] == DO_EXECUTE:
                     if not self.real_runner:
                         raise Exception("TestCommandProvider was asked to really execute something; but doesn't have a means to do so")
-                    return self.real_runner.run(args, shell=shell, clean_return=clean_return)
+                    return self.real_runner.run(args, shell=shell, clean_return=clean_return, cwd=cwd, env=env)
                 else:
                     func = self.mappings[m]
 
@@ -4,8 +4,11 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import sys
 import copy
+import shutil
+import tempfile
 import unittest
 
 sys.path.append(".")
@@ -31,17 +34,18 @@ COMMITS_MAIN_R.reverse()
 class TestCommandRunner(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        loggingProvider = SimpleLogger(localconfig['Logging'])
+        cls.loggingProvider = SimpleLogger(localconfig['Logging'])
 
-        real_command_runner = CommandProvider({})
-        real_command_runner.update_config({
-            'LoggingProvider': loggingProvider
+        cls.real_command_runner = CommandProvider({})
+        cls.real_command_runner.update_config({
+            'LoggingProvider': cls.loggingProvider
         })
 
-        cls.scmProvider = SCMProvider({})
+        cls.mirror_dir = tempfile.mkdtemp()
+        cls.scmProvider = SCMProvider({'mirror_dir': cls.mirror_dir})
         cls.scmProvider.update_config({
-            'CommandProvider': real_command_runner,
-            'LoggingProvider': loggingProvider
+            'CommandProvider': cls.real_command_runner,
+            'LoggingProvider': cls.loggingProvider
         })
 
         cls.repo_url = test_repo_path_wrapper(default_test_repo())
@@ -52,6 +56,7 @@ class TestCommandRunner(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         cls.scmProvider.reset()
+        shutil.rmtree(cls.mirror_dir, ignore_errors=True)
 
     def testCommitsBetween(self):
         # Test a full commits between test
@@ -100,6 +105,155 @@ class TestCommandRunner(unittest.TestCase):
         for i in range(len(unseen_new_upstream_commits) - 1):
             self.assertEqual(unseen_new_upstream_commits[i].revision, COMMITS_MAIN_R[i + len(COMMITS_MAIN_R) - 3])
 
+    def testCheckForUpdatesDetails(self):
+        library, task = self._get_library()
+
+        new_version = COMMITS_MAIN[0]
+        library.revision = COMMITS_MAIN[3]
+        all_new_upstream_commits, unseen_new_upstream_commits = self.scmProvider.check_for_update(library, task, new_version, most_recent_job=None)
+        self.assertEqual([c.revision for c in all_new_upstream_commits], COMMITS_MAIN_R[-3:])
+
+        renamed, readme, removed = all_new_upstream_commits
+        self.assertEqual(renamed.summary, "Rename file\n")
+        self.assertEqual(renamed.files_other, ["R100 do_more.c"])
+        self.assertEqual(renamed.revision_link, self.repo_url + "/commit/" + renamed.revision)
+        self.assertEqual(readme.files_modified, ["README"])
+        self.assertEqual(removed.files_deleted, ["utilities.c"])
+        for c in unseen_new_upstream_commits:
+            self.assertTrue(c.populated)
+
+    def testCheckForUpdatesUpstreamUnchanged(self):
+        library, task = self._get_library()
+
+        # The test repo's HEAD is on anotherbranch. If we're already there, we shouldn't need a mirror at all.
+        mirror_dir = tempfile.mkdtemp()
+        scmProvider = SCMProvider({'mirror_dir': mirror_dir})
+        scmProvider.update_config({
+            'CommandProvider': self.real_command_runner,
+            'LoggingProvider': self.loggingProvider
+        })
+        scmProvider.initialize()
+        try:
+            library.revision = COMMITS_BRANCH2[0]
+            all_new_upstream_commits, unseen_new_upstream_commits = scmProvider.check_for_update(library, task, "HEAD", most_recent_job=None)
+            self.assertEqual(len(all_new_upstream_commits), 0)
+            self.assertEqual(len(unseen_new_upstream_commits), 0)
+            self.assertEqual(os.listdir(mirror_dir), [])
+        finally:
+            scmProvider.reset()
+            shutil.rmtree(mirror_dir, ignore_errors=True)
+
+    def testMirrorIsFullClone(self):
+        # A partial clone would fetch blobs from upstream during git log's rename detection
+        ret = self.real_command_runner.run(["git", "config", "--get", "remote.origin.promisor"], clean_return=False, cwd=self.scmProvider.mirror_path)
+        self.assertNotEqual(ret.returncode, 0)
+
+    def testMirrorUpdates(self):
+        upstream_dir = tempfile.mkdtemp()
+        mirror_dir = tempfile.mkdtemp()
+
+        def git(cwd, *args):
+            return self.real_command_runner.run(["git", "-c", "user.name=Test", "-c", "user.email=test@example.com"] + list(args), cwd=cwd).stdout.decode().strip()
+
+        def new_provider():
+            scmProvider = SCMProvider({'mirror_dir': mirror_dir})
+            scmProvider.update_config({
+                'CommandProvider': self.real_command_runner,
+                'LoggingProvider': self.loggingProvider
+            })
+            scmProvider.initialize()
+            return scmProvider
+
+        try:
+            git(upstream_dir, "init", "-q", "-b", "master")
+            git(upstream_dir, "commit", "-q", "--allow-empty", "-m", "one")
+            git(upstream_dir, "update-ref", "refs/pull/1/head", "HEAD")
+
+            # A task that fails never resets, so check_for_update must remove its worktree itself
+            failed = new_provider()
+            failed._ensure_checkout(upstream_dir)
+            self.assertEqual(git(failed.mirror_path, "for-each-ref", "refs/pull"), "")
+            library = Struct(**{'repo_url': upstream_dir, 'name': 'Test-Library', 'revision': "0" * 40})
+            with self.assertRaises(Exception):
+                failed.check_for_update(library, Struct(**{'branch': None}), "master", most_recent_job=None)
+            self.assertFalse(os.path.exists(failed.tmpdirname))
+
+            # Upstream renames its default branch
+            git(upstream_dir, "branch", "-m", "master", "main")
+
+            scmProvider = new_provider()
+            try:
+                scmProvider._ensure_checkout(upstream_dir)
+                self.assertEqual(git(scmProvider.mirror_path, "symbolic-ref", "HEAD"), "refs/heads/main")
+                self.assertEqual(git(scmProvider.mirror_path, "for-each-ref", "--format=%(refname)", "refs/heads"), "refs/heads/main")
+                self.assertNotIn(failed.tmpdirname, git(scmProvider.mirror_path, "worktree", "list", "--porcelain"))
+            finally:
+                scmProvider.reset()
+        finally:
+            shutil.rmtree(upstream_dir, ignore_errors=True)
+            shutil.rmtree(mirror_dir, ignore_errors=True)
+
+    def testMirrorMovedTag(self):
+        upstream_dir = tempfile.mkdtemp()
+        mirror_dir = tempfile.mkdtemp()
+
+        def git(cwd, *args):
+            return self.real_command_runner.run(["git", "-c", "user.name=Test", "-c", "user.email=test@example.com"] + list(args), cwd=cwd).stdout.decode().strip()
+
+        def checkout_nightly():
+            scmProvider = SCMProvider({'mirror_dir': mirror_dir})
+            scmProvider.update_config({
+                'CommandProvider': self.real_command_runner,
+                'LoggingProvider': self.loggingProvider
+            })
+            scmProvider.initialize()
+            try:
+                scmProvider._ensure_checkout(upstream_dir)
+                return git(scmProvider.mirror_path, "rev-parse", "nightly")
+            finally:
+                scmProvider.reset()
+
+        try:
+            git(upstream_dir, "init", "-q", "-b", "main")
+            git(upstream_dir, "commit", "-q", "--allow-empty", "-m", "one")
+            git(upstream_dir, "tag", "nightly")
+            self.assertEqual(checkout_nightly(), git(upstream_dir, "rev-parse", "HEAD"))
+
+            # Upstream moves the tag, which a plain fetch would refuse to clobber
+            git(upstream_dir, "commit", "-q", "--allow-empty", "-m", "two")
+            git(upstream_dir, "tag", "-f", "nightly")
+            self.assertEqual(checkout_nightly(), git(upstream_dir, "rev-parse", "HEAD"))
+
+            # A mirror we can't fetch into is cloned again rather than failing every run
+            mirror_path = os.path.join(mirror_dir, os.listdir(mirror_dir)[0])
+            git(mirror_path, "config", "remote.origin.url", os.path.join(upstream_dir, "nonexistent"))
+            git(upstream_dir, "commit", "-q", "--allow-empty", "-m", "three")
+            git(upstream_dir, "tag", "-f", "nightly")
+            self.assertEqual(checkout_nightly(), git(upstream_dir, "rev-parse", "HEAD"))
+        finally:
+            shutil.rmtree(upstream_dir, ignore_errors=True)
+            shutil.rmtree(mirror_dir, ignore_errors=True)
+
+    def testRemoteRevisionExactBranch(self):
+        # ls-remote would also report refs/heads/a/main (first) when asked about 'main'
+        repo_dir = tempfile.mkdtemp()
+        try:
+            def git(*args):
+                return self.real_command_runner.run(["git", "-c", "user.name=Test", "-c", "user.email=test@example.com"] + list(args), cwd=repo_dir).stdout.decode().strip()
+            git("init", "-q", "-b", "main")
+            git("commit", "-q", "--allow-empty", "-m", "one")
+            main_revision = git("rev-parse", "HEAD")
+            git("checkout", "-q", "-b", "a/main")
+            git("commit", "-q", "--allow-empty", "-m", "two")
+            other_revision = git("rev-parse", "HEAD")
+
+            self.assertEqual(self.scmProvider._remote_revision(repo_dir, "main"), main_revision)
+            self.assertEqual(self.scmProvider._remote_revision(repo_dir, "a/main"), other_revision)
+            self.assertEqual(self.scmProvider._remote_revision(repo_dir, "HEAD"), other_revision)
+            self.assertEqual(self.scmProvider._remote_revision(repo_dir, "nonexistent"), None)
+        finally:
+            shutil.rmtree(repo_dir, ignore_errors=True)
+
     def testCheckForUpdatesOnTag(self):
         library, task = self._get_library()
 
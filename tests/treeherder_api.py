@@ -7,20 +7,25 @@
 import os
 import sys
 import json
+import time
+import shutil
+import tempfile
 import unittest
 
 from http import server
 from threading import Thread
 
+from requests.adapters import HTTPAdapter
+
 sys.path.append(".")
 sys.path.append("..")
 from components.logging import SimpleLoggerConfig
-from components.utilities import static_vars
-from apis.taskcluster import TaskclusterProvider
+from components.utilities import static_vars, Struct
+from apis.taskcluster import TaskclusterProvider, _write_cache, FAILURE_CLASSIFICATIONS_CACHE_TTL
 
 from tests.functionality_utilities import treeherder_response
 from tests.mock_commandprovider import TestCommandProvider
-from tests.mock_treeherder_server import MockTreeherderServerFactory, FAILURE_CLASSIFICATIONS, EXPECTED_RETRIGGER_DECISION_TASK, TYPE_HEALTH
+from tests.mock_treeherder_server import MockTreeherderServerFactory, FAILURE_CLASSIFICATIONS, EXPECTED_RETRIGGER_DECISION_TASK, RETRIGGER_RESPONSE, TYPE_HEALTH
 
 
 # Because jobs_count won't be consistent because we call this function for all tests
@@ -37,6 +42,14 @@ def treeherder_responses(requesttype, fullpath):
             treeherder_responses.have_sent_page_1 = True
             return "jobs_paged_1.txt"
 
+    # These pages don't report a count, so they can only be walked through 'next'
+    if "push_id=next" in fullpath:
+        if "page=3" in fullpath:
+            return "jobs_next_3.txt"
+        if "page=2" in fullpath:
+            return "jobs_next_2.txt"
+        return "jobs_next_1.txt"
+
     if "health_rev" in fullpath:
         if requesttype == TYPE_HEALTH:
             return "health_correlation_example.txt"
@@ -45,16 +58,29 @@ def treeherder_responses(requesttype, fullpath):
     return ""
 
 
+def _write_stale_cache(path):
+    # Cache the failure classifications, backdated so they're already past their TTL
+    _write_cache(path, json.loads(FAILURE_CLASSIFICATIONS))
+    with open(path) as f:
+        cached = json.load(f)
+    cached['timestamp'] = time.time() - FAILURE_CLASSIFICATIONS_CACHE_TTL - 1
+    with open(path, "w") as f:
+        json.dump(cached, f)
+    return cached
+
+
 class TestTaskclusterProvider(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         cls.server = server.HTTPServer(('', 27490), MockTreeherderServerFactory(treeherder_responses))
         cls.commandProvider = TestCommandProvider({})
         cls.commandProvider.update_config(SimpleLoggerConfig)
+        cls.cache_dir = tempfile.mkdtemp()
 
         cls.taskclusterProvider = TaskclusterProvider({
             'url_treeherder': 'http://localhost:27490/',
             'url_taskcluster': 'http://localhost:27490/',
+            'cache_dir': cls.cache_dir,
         })
         additional_config = SimpleLoggerConfig
         additional_config.update({'CommandProvider': cls.commandProvider})
@@ -67,12 +93,62 @@ class TestTaskclusterProvider(unittest.TestCase):
     def tearDownClass(cls):
         cls.server.shutdown()
         cls.server.server_close()
+        shutil.rmtree(cls.cache_dir, ignore_errors=True)
 
     def test_failure_classification(self):
         f = self.taskclusterProvider.failure_classifications
         j = json.loads(FAILURE_CLASSIFICATIONS)
         self.assertEqual(j[0]['name'], f[7])
 
+    def _provider_without_retries(self, url_treeherder):
+        # Don't sit through the session's retry backoff when the server is down or erroring
+        provider = TaskclusterProvider({
+            'url_treeherder': url_treeherder,
+            'cache_dir': self.cache_dir,
+        })
+        provider.update_config(SimpleLoggerConfig)
+        provider._session.mount("http://", HTTPAdapter(max_retries=0))
+        return provider
+
+    def test_failure_classification_stale_cache(self):
+        # Nothing is listening on this port, so we must fall back to the stale cached copy
+        offlineProvider = self._provider_without_retries('http://localhost:27491/')
+        _write_stale_cache(offlineProvider._get_failure_classifications_cache_path())
+
+        f = offlineProvider.failure_classifications
+        self.assertEqual("autoclassified intermittent", f[7])
+
+    def test_failure_classification_error_response(self):
+        # The server answers with a JSON error body, which must not replace the stale cached copy
+        class ErrorServer(server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(503)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+                self.wfile.write(b'{"detail": "Service Unavailable"}')
+
+        error_server = server.HTTPServer(('', 27492), ErrorServer)
+        t = Thread(target=error_server.serve_forever)
+        t.start()
+        try:
+            errorProvider = self._provider_without_retries('http://localhost:27492/')
+            cache_path = errorProvider._get_failure_classifications_cache_path()
+
+            # Without any cached copy, the error is raised and nothing is cached
+            with self.assertRaises(Exception):
+                errorProvider.failure_classifications
+            self.assertFalse(os.path.exists(cache_path))
+
+            cached = _write_stale_cache(cache_path)
+
+            f = errorProvider.failure_classifications
+            self.assertEqual("autoclassified intermittent", f[7])
+            with open(cache_path) as f:
+                self.assertEqual(cached, json.load(f))
+        finally:
+            error_server.shutdown()
+            error_server.server_close()
+
     def test_push_exception_handling(self):
         try:
             self.taskclusterProvider.get_job_details('rev_broken')
@@ -86,11 +162,24 @@ class TestTaskclusterProvider(unittest.TestCase):
         job_list = self.taskclusterProvider.get_job_details('1')
         self.assertEqual(len(job_list), 3737, "Did not receive the correct number of jobs from the server.")
 
+    def test_job_details_next_links(self):
+        job_list = self.taskclusterProvider.get_job_details('next')
+        self.assertEqual([j.id for j in job_list], [307398903, 307399419, 307399420, 307399421, 307399422])
+        self.assertEqual(job_list[0].job_type_name, "Gecko Decision Task")
+        self.assertEqual(job_list[4].decision_task, job_list[0])
+
     def test_push_health(self):
         push_health = self.taskclusterProvider.get_push_health("health_rev")
         self.assertEqual(len(push_health['metrics']['tests']['details']['needInvestigation']), 38, "Did not get expected number of needs-investigation tests")
         self.assertEqual(len(push_health['metrics']['tests']['details']['knownIssues']), 14, "Did not get expected number of known-issue tests")
 
+    def test_job_details_and_health(self):
+        job_list, push_health = self.taskclusterProvider.get_job_details_and_health("health_rev")
+        self.assertEqual(len(push_health['metrics']['tests']['details']['needInvestigation']), 38, "Did not get expected number of needs-investigation tests")
+
+        results = self.taskclusterProvider.determine_jobs_to_retrigger(push_health, job_list)
+        self.assertEqual(len(results['to_retrigger']), 26, "Did not get the expected number of jobs to retrigger.")
+
     def test_combine(self):
         file_prefix = "tests/" if not os.getcwd().endswith("tests") else ""
         file_prefix += "treeherder_api_responses/"
@@ -168,6 +257,54 @@ class TestTaskclusterProvider(unittest.TestCase):
         decision_tasks = self.taskclusterProvider.retrigger_jobs(to_retrigger)
         self.assertEqual(EXPECTED_RETRIGGER_DECISION_TASK, decision_tasks[0])
 
+    def test_retrigger_payload(self):
+        # Serve an actions.json whose hook template has a newline and a literal backslash-n
+        # in it, and capture what we post to the hook
+        with open("tests/treeherder_api_responses/actionsjson.txt" if not os.getcwd().endswith("tests") else "treeherder_api_responses/actionsjson.txt") as f:
+            actions = json.load(f)
+        retrigger_action = [a for a in actions['actions'] if a['name'] == "retrigger-multiple"][0]
+        retrigger_action['hookPayload']['decision']['action']['description'] = "Create a clone\nof the task."
+        retrigger_action['hookPayload']['decision']['action']['path'] = "C:\\new dir"
+        posted = []
+
+        class ActionsServer(server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps(actions).encode())
+
+            def do_POST(self):
+                posted.append((self.headers['Content-Type'], self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+                self.wfile.write(RETRIGGER_RESPONSE.encode())
+
+        actions_server = server.HTTPServer(('', 27493), ActionsServer)
+        t = Thread(target=actions_server.serve_forever)
+        t.start()
+        try:
+            actionsProvider = TaskclusterProvider({
+                'url_taskcluster': 'http://localhost:27493/',
+                'cache_dir': self.cache_dir,
+            })
+            actionsProvider.update_config(SimpleLoggerConfig)
+
+            job = [j for j in self.taskclusterProvider.get_job_details('1') if j.job_type_name == "source-test-mozlint-mingw-cap"][0]
+            to_retrigger = [Struct(**{'job_type_name': "source-test-mozlint\nmingw-cap", 'decision_task': job.decision_task})]
+            self.assertEqual([EXPECTED_RETRIGGER_DECISION_TASK], actionsProvider.retrigger_jobs(to_retrigger))
+        finally:
+            actions_server.shutdown()
+            actions_server.server_close()
+
+        content_type, body = posted[0]
+        self.assertEqual("application/json", content_type)
+        payload = json.loads(body)
+        self.assertEqual("Create a clone of the task.", payload['decision']['action']['description'])
+        self.assertEqual("C:\\new dir", payload['decision']['action']['path'])
+        self.assertEqual(["source-test-mozlint mingw-cap"], payload['user']['input']['requests'][0]['tasks'])
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=0)